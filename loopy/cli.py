@@ -4,8 +4,6 @@ import sys
 import signal
 import logging
 import click
-from .loop import Loop
-from .models import ItemStatus
 
 logging.basicConfig()
 
@@ -13,7 +11,9 @@ logging.basicConfig()
 def handler(signum, frame):
     match signum:
         case signal.SIGTERM:
-            sys.exit(1)
+            # Raised in the main thread so that Loop.run can stop the running
+            # commands and record them before exiting
+            sys.exit(128 + signum)
 
 
 signal.signal(signal.SIGTERM, handler)
@@ -35,7 +35,7 @@ def main(ctx, loop_id, db_path):
         "run",
         "reset",
         "delete",
-        "cmd",
+        "edit-cmd",
         "copy-from",
         "read-items",
         "list-items",
@@ -50,15 +50,18 @@ def main(ctx, loop_id, db_path):
         "run",
         "reset",
         "delete",
-        "cmd",
+        "edit-cmd",
         "read-items",
         "list-items",
         "edit-items",
     ]:
+        from .loop import Loop
+
         loop = Loop(loop_id, db_path=db_path)
         if not loop.exists():
             click.echo(f"Loop {loop_id} not found")
             sys.exit(1)
+        ctx.obj["loop"] = loop
 
     # If no subcommand, default to list
     if ctx.invoked_subcommand is None:
@@ -66,22 +69,32 @@ def main(ctx, loop_id, db_path):
 
 
 @main.command()
+@click.option(
+    "--shell",
+    is_flag=True,
+    help="Run the command through the shell, for pipelines and other shell syntax",
+)
 @click.argument("command", nargs=-1, required=True)
 @click.pass_context
-def create(ctx, command):
+def create(ctx, shell, command):
     """Create a new loop."""
+    from .loop import Loop
+
     loop_id = ctx.obj["loop_id"]
 
     if "{}" not in command:
         command = list(command) + ["{}"]
     cmd_str = " ".join(command)
 
-    # Read items from stdin
-    click.echo("Reading items from standard input", err=True)
-    items = [line.strip() for line in sys.stdin if line.strip()]
-
     try:
-        Loop.create(loop_id, cmd_str, items, db_path=ctx.obj["db_path"])
+        # Checked first, so a bad command isn't reported after reading stdin
+        Loop.check_command(cmd_str, shell)
+
+        # Read items from stdin
+        click.echo("Reading items from standard input", err=True)
+        items = [item for line in sys.stdin if (item := line.strip())]
+
+        Loop.create(loop_id, cmd_str, items, db_path=ctx.obj["db_path"], shell=shell)
         click.echo(f"Loop {loop_id} created")
     except ValueError as e:
         click.echo(str(e))
@@ -92,13 +105,22 @@ def create(ctx, command):
 @click.option(
     "--continue-on-failure", is_flag=True, help="Continue processing even if items fail"
 )
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of items to run concurrently",
+)
 @click.pass_context
-def run(ctx, continue_on_failure):
+def run(ctx, continue_on_failure, jobs):
     """Run an existing loop."""
-    loop_id = ctx.obj["loop_id"]
-
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
-    success = loop.run(continue_on_failure)
+    loop = ctx.obj["loop"]
+    try:
+        success = loop.run(continue_on_failure, jobs=jobs)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
     sys.exit(0 if success else 1)
 
 
@@ -108,7 +130,7 @@ def reset(ctx):
     """Reset loop to start from beginning."""
     loop_id = ctx.obj["loop_id"]
 
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
+    loop = ctx.obj["loop"]
     loop.reset()
     click.echo(f"Loop {loop_id} reset")
 
@@ -119,23 +141,32 @@ def delete(ctx):
     """Delete a loop."""
     loop_id = ctx.obj["loop_id"]
 
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
+    loop = ctx.obj["loop"]
     loop.delete()
     click.echo(f"Loop {loop_id} deleted")
 
 
 @main.command(name="edit-cmd")
+@click.option(
+    "--shell/--no-shell",
+    default=None,
+    help="Change whether the command is run through the shell",
+)
 @click.argument("command", nargs=-1, required=True)
 @click.pass_context
-def cmd(ctx, command):
+def cmd(ctx, shell, command):
     """Update loop command."""
     loop_id = ctx.obj["loop_id"]
 
     if "{}" not in command:
         command = list(command) + ["{}"]
     cmd_str = " ".join(command)
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
-    loop.update_command(cmd_str)
+    loop = ctx.obj["loop"]
+    try:
+        loop.update_command(cmd_str, shell=shell)
+    except ValueError as e:
+        click.echo(str(e))
+        sys.exit(1)
     click.echo(f"Loop {loop_id} command updated")
 
 
@@ -144,6 +175,8 @@ def cmd(ctx, command):
 @click.pass_context
 def copy_from(ctx, source_id):
     """Copy from another loop."""
+    from .loop import Loop
+
     loop_id = ctx.obj["loop_id"]
 
     source_loop = Loop(source_id, db_path=ctx.obj["db_path"])
@@ -173,13 +206,13 @@ def read_items(ctx, append, replace):
     loop_id = ctx.obj["loop_id"]
 
     # Read items from stdin
-    items = [line.strip() for line in sys.stdin if line.strip()]
+    items = [item for line in sys.stdin if (item := line.strip())]
 
     if not items:
         click.echo("No items provided via stdin")
         sys.exit(1)
 
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
+    loop = ctx.obj["loop"]
 
     if replace:
         loop.replace_items(items)
@@ -194,11 +227,10 @@ def read_items(ctx, append, replace):
 def edit_items(ctx):
     """Edit loop items in a text editor."""
     loop_id = ctx.obj["loop_id"]
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
+    loop = ctx.obj["loop"]
 
     # Get current items
-    current_items = loop.list_items()
-    initial_text = "\n".join([item for item, _, _ in current_items])
+    initial_text = "\n".join(item for item, _, _ in loop.list_items())
 
     # Open editor
     edited_text = click.edit(initial_text)
@@ -208,9 +240,7 @@ def edit_items(ctx):
         return
 
     # Parse edited items
-    new_items = [
-        line.strip() for line in edited_text.strip().split("\n") if line.strip()
-    ]
+    new_items = [item for line in edited_text.splitlines() if (item := line.strip())]
 
     # Replace items
     loop.replace_items(new_items)
@@ -222,57 +252,64 @@ def edit_items(ctx):
 @click.pass_context
 def list_items(ctx, raw):
     """List items in a loop."""
-    loop_id = ctx.obj["loop_id"]
-    loop = Loop(loop_id, db_path=ctx.obj["db_path"])
+    from .models import ItemStatus
+
+    loop = ctx.obj["loop"]
     items = loop.list_items()
 
     if not items:
         click.echo("No items found", err=True)
         return
 
+    # Written in one go rather than a line at a time
+    lines = []
     for item, status, attempts in items:
         if raw:
-            click.echo(item)
+            lines.append(item)
         elif status == ItemStatus.PENDING:
-            click.echo(f"  {item}")
+            lines.append(f"  {item}")
         elif status == ItemStatus.SUCCESS:
-            click.echo(f"✓ {item}")
+            lines.append(f"✓ {item}")
         else:
-            click.echo(f"✗ {item} (failed {attempts} times)")
+            lines.append(f"✗ {item} (failed {attempts} times)")
+    click.echo("\n".join(lines))
 
 
 @main.command()
 @click.pass_context
 def clean(ctx):
     """Remove loops where all items are completed."""
-    loops = Loop.list_all(db_path=ctx.obj["db_path"])
-    cleaned_count = 0
+    from .loop import Loop
 
-    for loop_id, command, status, pending, failed, done, total in loops:
-        if total > 0 and pending == 0 and failed == 0:
-            loop = Loop(loop_id, db_path=ctx.obj["db_path"])
-            loop.delete()
-            click.echo(f"Cleaned loop {loop_id}")
-            cleaned_count += 1
+    loop_ids = Loop.delete_completed(db_path=ctx.obj["db_path"])
 
-    if cleaned_count == 0:
+    if not loop_ids:
         click.echo("No completed loops to clean")
-    else:
-        click.echo(f"Cleaned {cleaned_count} completed loops")
+        return
+
+    lines = [f"Cleaned loop {loop_id}" for loop_id in loop_ids]
+    lines.append(f"Cleaned {len(loop_ids)} completed loops")
+    click.echo("\n".join(lines))
 
 
 @main.command(name="list")
 @click.pass_context
 def list_(ctx):
     """List all loops."""
+    from .loop import Loop
+
     loops = Loop.list_all(db_path=ctx.obj["db_path"])
 
     if not loops:
         click.echo("No loops found")
         return
 
-    for loop_id, command, status, pending, failed, done, total in loops:
-        click.echo(f"{loop_id}: {command} ({pending}/{failed}/{done}/{total})")
+    click.echo(
+        "\n".join(
+            f"{loop_id}: {command} ({pending}/{failed}/{done}/{total})"
+            for loop_id, command, status, pending, failed, done, total in loops
+        )
+    )
 
 
 if __name__ == "__main__":
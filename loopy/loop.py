@@ -1,12 +1,180 @@
 """Loop class for executing commands."""
 
+import os
+import selectors
+import shlex
 import subprocess
 import signal
+import sys
+from contextlib import suppress
 from os import killpg
+from itertools import batched
 from typing import List, Optional
-from sqlmodel import Session, select
+from sqlmodel import (
+    Session,
+    bindparam,
+    case,
+    delete,
+    exists,
+    func,
+    select,
+    update,
+)
 from .models import LoopModel, LoopItem, ItemStatus, get_session
 
+# Number of finished items whose status is written per transaction in run()
+COMMIT_BATCH_SIZE = 32
+
+# Number of new items sent to the database per INSERT
+INSERT_BATCH_SIZE = 10000
+
+# Maximum number of bytes read from a command's output at a time
+READ_SIZE = 65536
+
+# Records how a run of an item ended. This is a Core statement, built once, so
+# that a batch of results is written with one executemany and no ORM flush.
+_UPDATE_ITEM = (
+    update(LoopItem.__table__)
+    .where(LoopItem.__table__.c.id == bindparam("b_id"))
+    .values(
+        status=bindparam("b_status"),
+        attempts=bindparam("b_attempts"),
+        last_error=bindparam("b_error"),
+    )
+)
+
+
+def _insert_new_items(session: Session, loop_id: str, items: List[str]):
+    """Insert items that have not been run yet, INSERT_BATCH_SIZE at a time."""
+    for batch in batched(items, INSERT_BATCH_SIZE):
+        session.bulk_insert_mappings(
+            LoopItem,
+            [
+                {
+                    "loop_id": loop_id,
+                    "item": item,
+                    "status": ItemStatus.PENDING,
+                    "attempts": 0,
+                }
+                for item in batch
+            ],
+        )
+
+
+def _split_command(command: str) -> List[str]:
+    """Split a command template into arguments, as run() does without a shell."""
+    try:
+        return shlex.split(command)
+    except ValueError as e:
+        raise ValueError(f"Cannot parse command {command!r}: {e}") from None
+
+
+def _failure(item_id: int, attempts: int, error: str) -> dict:
+    """Build the _UPDATE_ITEM parameters recording that an item failed."""
+    return {
+        "b_id": item_id,
+        "b_status": ItemStatus.FAILED,
+        "b_attempts": attempts + 1,
+        "b_error": error,
+    }
+
+
+class _Job:
+    """An item whose command is running, waited on through a selector.
+
+    Readiness of the output pipe and, where pidfd_open is available, exit of the
+    process are both watched, so many children can be multiplexed without
+    polling or blocking on any one of them.
+    """
+
+    def __init__(
+        self,
+        selector: selectors.BaseSelector,
+        item_id: int,
+        item: str,
+        attempts: int,
+        process: subprocess.Popen,
+    ):
+        self.selector = selector
+        self.item_id = item_id
+        self.item = item
+        self.attempts = attempts
+        self.process = process
+        self.stdout = process.stdout.fileno()
+        self.prefix = item.encode() + b": "
+        # Output received after the last complete line
+        self.output = bytearray()
+        os.set_blocking(self.stdout, False)
+
+        self.fds = [self.stdout]
+        try:
+            self.fds.append(os.pidfd_open(process.pid))
+        except (AttributeError, OSError):
+            # pidfd needs Linux 5.3; reap the process once its output is closed
+            pass
+        for fd in self.fds:
+            selector.register(fd, selectors.EVENT_READ, self)
+
+    def ready(self, fd: int) -> bool:
+        """Handle an event on fd and return whether the job has finished."""
+        if fd == self.stdout:
+            try:
+                chunk = os.read(fd, READ_SIZE)
+            except BlockingIOError:
+                return False
+            if chunk:
+                self.output += chunk
+                end = self.output.rfind(b"\n")
+                if end >= 0:
+                    self._write(self.output[:end].split(b"\n"))
+                    del self.output[: end + 1]
+                return False
+            if self.output:
+                self._write([self.output])
+        # Otherwise the process exited; its output may still be draining
+
+        self._unregister(fd)
+        return not self.fds
+
+    def success(self) -> dict:
+        """Build the _UPDATE_ITEM parameters recording that the item succeeded."""
+        return {
+            "b_id": self.item_id,
+            "b_status": ItemStatus.SUCCESS,
+            "b_attempts": self.attempts,
+            "b_error": None,
+        }
+
+    def failure(self, error: str) -> dict:
+        """Build the _UPDATE_ITEM parameters recording that the item failed."""
+        return _failure(self.item_id, self.attempts, error)
+
+    def terminate(self):
+        """Send SIGTERM to the command and the rest of its process group."""
+        with suppress(ProcessLookupError):
+            killpg(self.process.pid, signal.SIGTERM)
+
+    def close(self):
+        """Stop watching the job."""
+        for fd in list(self.fds):
+            self._unregister(fd)
+
+    def _unregister(self, fd: int):
+        self.selector.unregister(fd)
+        self.fds.remove(fd)
+        if fd == self.stdout:
+            self.process.stdout.close()
+        else:
+            os.close(fd)
+
+    def _write(self, lines: List[bytes]):
+        """Write lines of output, prefixed with the item, to stdout."""
+        sys.stdout.flush()
+        sys.stdout.buffer.write(
+            b"".join(self.prefix + line.rstrip() + b"\n" for line in lines)
+        )
+        sys.stdout.buffer.flush()
+
 
 class Loop:
     def __init__(
@@ -26,218 +194,355 @@ class Loop:
         items: List[str],
         session: Optional[Session] = None,
         db_path: Optional[str] = None,
+        shell: bool = False,
     ):
-        """Create a new loop with items."""
+        """Create a new loop with items.
+
+        The command is split into arguments and run directly unless shell is
+        set, in which case it is run through the shell.
+        """
+        cls.check_command(command, shell)
         session = session or get_session(db_path)
 
         # Check if loop already exists
-        existing = session.get(LoopModel, loop_id)
-        if existing:
+        loop = cls(loop_id, session, db_path)
+        if loop.exists():
             raise ValueError(f"Loop {loop_id} already exists")
 
-        loop_model = LoopModel(id=loop_id, command=command)
+        loop_model = LoopModel(id=loop_id, command=command, shell=shell)
         session.add(loop_model)
-
-        for item in items:
-            item_model = LoopItem(loop_id=loop_id, item=item)
-            session.add(item_model)
+        session.flush()
+        _insert_new_items(session, loop_id, items)
 
         session.commit()
-        return cls(loop_id, session, db_path)
+        return loop
+
+    @staticmethod
+    def check_command(command: str, shell: bool = False):
+        """Raise ValueError if command needs splitting and can't be split."""
+        if not shell:
+            _split_command(command)
 
     @classmethod
     def list_all(cls, session: Optional[Session] = None, db_path: Optional[str] = None):
         """List all loops with progress."""
         session = session or get_session(db_path)
+
+        def count(status):
+            return func.sum(case((LoopItem.status == status, 1), else_=0))
+
         loops = session.exec(
-            select(LoopModel).order_by(LoopModel.created_at.desc())
-        ).all()
+            select(
+                LoopModel.id,
+                LoopModel.command,
+                LoopModel.status,
+                count(ItemStatus.PENDING),
+                count(ItemStatus.FAILED),
+                count(ItemStatus.SUCCESS),
+                func.count(LoopItem.id),
+            )
+            .join(LoopItem, isouter=True)
+            .group_by(LoopModel.id)
+            .order_by(LoopModel.created_at.desc())
+        )
 
-        result = []
-        for loop in loops:
-            loop_instance = cls(loop.id, session, db_path)
-            pending, failed, done, total = loop_instance.get_progress()
-            result.append(
-                (loop.id, loop.command, loop.status, pending, failed, done, total)
+        return [tuple(loop) for loop in loops]
+
+    @classmethod
+    def delete_completed(
+        cls, session: Optional[Session] = None, db_path: Optional[str] = None
+    ):
+        """Delete loops whose items have all succeeded, returning their IDs."""
+        session = session or get_session(db_path)
+        loop_ids = session.exec(
+            select(LoopModel.id)
+            .join(LoopItem)
+            .group_by(LoopModel.id)
+            .having(
+                func.sum(case((LoopItem.status != ItemStatus.SUCCESS, 1), else_=0)) == 0
             )
+            .order_by(LoopModel.created_at.desc())
+        ).all()
+
+        if loop_ids:
+            session.exec(delete(LoopItem).where(LoopItem.loop_id.in_(loop_ids)))
+            session.exec(delete(LoopModel).where(LoopModel.id.in_(loop_ids)))
+            session.commit()
 
-        return result
+        return loop_ids
 
     def exists(self):
         """Check if loop exists."""
-        return self.session.get(LoopModel, self.loop_id) is not None
+        return self.session.exec(
+            select(exists().where(LoopModel.id == self.loop_id))
+        ).one()
 
-    def run(self, continue_on_failure: bool = False, timeout: Optional[int] = None):
-        """Execute the loop."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
+    def run(
+        self,
+        continue_on_failure: bool = False,
+        timeout: Optional[int] = None,
+        jobs: int = 1,
+    ):
+        """Execute the loop, running up to jobs items at a time."""
+        loop = self.session.exec(
+            select(LoopModel.command, LoopModel.shell).where(
+                LoopModel.id == self.loop_id
+            )
+        ).first()
+        if loop is None:
             raise ValueError(f"Loop {self.loop_id} not found")
-
-        pending_items = [
-            item for item in loop_model.items if item.status == ItemStatus.PENDING
-        ]
+        command, shell = loop
+
+        # Plain rows rather than instances, so that the periodic commits have
+        # nothing to expire and refresh
+        pending_items = self.session.exec(
+            select(LoopItem.id, LoopItem.item, LoopItem.attempts)
+            .where(
+                LoopItem.loop_id == self.loop_id,
+                LoopItem.status == ItemStatus.PENDING,
+            )
+            .order_by(LoopItem.id)
+        ).all()
 
         if not pending_items:
             print(f"No pending items for loop {self.loop_id}")
             return True
 
-        success = True
-        for item_model in pending_items:
+        # Parsed once; only the {} placeholders change between items
+        argv = None
+        if not shell:
             try:
-                cmd = loop_model.command.replace("{}", item_model.item)
-                process = subprocess.Popen(
-                    cmd,
-                    shell=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    universal_newlines=True,
-                    start_new_session=True,
-                )
-
-                # Stream output in real-time
-                for line in process.stdout:
-                    print(f"{item_model.item}: {line.rstrip()}")
-
-                process.wait()
-
-                if process.returncode == 0:
-                    item_model.status = ItemStatus.SUCCESS
-                    self.session.commit()
-                else:
-                    item_model.status = ItemStatus.FAILED
-                    item_model.attempts += 1
-                    item_model.last_error = (
-                        f"Command failed with exit code {process.returncode}"
-                    )
-                    self.session.commit()
-                    success = False
-
-                    if not continue_on_failure:
+                argv = _split_command(command)
+            except ValueError as e:
+                raise ValueError(
+                    f"{e}; fix it with edit-cmd, or use edit-cmd --shell"
+                ) from None
+
+        selector = selectors.DefaultSelector()
+        queue = iter(pending_items)
+        running = []
+        stopping = False
+        success = True
+        updates = []
+        try:
+            while True:
+                while not stopping and len(running) < jobs:
+                    next_item = next(queue, None)
+                    if next_item is None:
+                        stopping = True
                         break
 
-            except subprocess.TimeoutExpired:
-                # Currently not used
-                assert 0
-                process.kill()
-                error_msg = f"Command timed out after {timeout} seconds"
-                item_model.status = ItemStatus.FAILED
-                item_model.attempts += 1
-                item_model.last_error = error_msg
-                self.session.commit()
-                print(f"{item_model.item}: {error_msg}")
-                success = False
-
-                if not continue_on_failure:
+                    item_id, item, attempts = next_item
+                    if shell:
+                        args = command.replace("{}", item)
+                    else:
+                        args = [arg.replace("{}", item) for arg in argv]
+
+                    try:
+                        process = subprocess.Popen(
+                            args,
+                            shell=shell,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            bufsize=0,
+                            start_new_session=True,
+                        )
+                    except OSError as e:
+                        # Without a shell, a missing program is reported here
+                        # rather than as exit code 127
+                        print(f"{item}: {e}")
+                        self._add_update(updates, _failure(item_id, attempts, str(e)))
+                        success = False
+                        if not continue_on_failure:
+                            stopping = True
+                        continue
+
+                    running.append(_Job(selector, item_id, item, attempts, process))
+
+                if not running:
                     break
 
-            except (KeyboardInterrupt, SystemExit):
-                killpg(process.pid, signal.SIGTERM)
-                raise
+                # Stream output in real-time
+                for key, _ in selector.select():
+                    job = key.data
+                    if not job.ready(key.fd):
+                        continue
+
+                    running.remove(job)
+                    returncode = job.process.wait()
+                    if returncode == 0:
+                        self._add_update(updates, job.success())
+                    else:
+                        self._add_update(
+                            updates,
+                            job.failure(f"Command failed with exit code {returncode}"),
+                        )
+                        success = False
+
+                        # Let running items finish, but don't start new ones
+                        if not continue_on_failure:
+                            stopping = True
+
+        except KeyboardInterrupt:
+            # Interrupted items stay pending and are run again next time
+            for job in running:
+                job.terminate()
+            raise
+
+        except SystemExit:
+            # The CLI turns SIGTERM into SystemExit
+            for job in running:
+                job.terminate()
+                updates.append(job.failure("Terminated by SIGTERM"))
+            raise
+
+        finally:
+            for job in running:
+                job.close()
+            selector.close()
+            # Also reached on interrupt, so finished items aren't run again
+            self._commit_updates(updates)
 
         return success
 
+    def _add_update(self, updates: List[dict], params: dict):
+        """Queue an item status update, writing the batch once it is full."""
+        updates.append(params)
+        if len(updates) >= COMMIT_BATCH_SIZE:
+            self._commit_updates(updates)
+
+    def _commit_updates(self, updates: List[dict]):
+        """Write accumulated item status updates in a single transaction."""
+        if not updates:
+            return
+        self.session.exec(_UPDATE_ITEM, params=updates)
+        self.session.commit()
+        updates.clear()
+
     def reset(self):
         """Reset loop to start from beginning."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
-            raise ValueError(f"Loop {self.loop_id} not found")
-
-        for item in loop_model.items:
-            item.status = ItemStatus.PENDING
-            item.attempts = 0
-            item.last_error = None
-
+        self.session.exec(
+            update(LoopItem)
+            .where(LoopItem.loop_id == self.loop_id)
+            .values(status=ItemStatus.PENDING, attempts=0, last_error=None)
+        )
         self.session.commit()
 
     def delete(self):
         """Delete the loop."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
+        self.session.exec(delete(LoopItem).where(LoopItem.loop_id == self.loop_id))
+        deleted = self.session.exec(
+            delete(LoopModel).where(LoopModel.id == self.loop_id)
+        ).rowcount
+        if not deleted:
+            self.session.rollback()
             raise ValueError(f"Loop {self.loop_id} not found")
 
-        # Items will be cascade deleted automatically
-        self.session.delete(loop_model)
         self.session.commit()
 
-    def update_command(self, command: str):
-        """Update loop command."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
+    def update_command(self, command: str, shell: Optional[bool] = None):
+        """Update loop command, and whether it is run through the shell if given."""
+        values = {"command": command}
+        if shell is None:
+            shell = self.session.exec(
+                select(LoopModel.shell).where(LoopModel.id == self.loop_id)
+            ).first()
+        else:
+            values["shell"] = shell
+        self.check_command(command, shell)
+
+        updated = self.session.exec(
+            update(LoopModel).where(LoopModel.id == self.loop_id).values(**values)
+        ).rowcount
+        if not updated:
             raise ValueError(f"Loop {self.loop_id} not found")
 
-        loop_model.command = command
         self.session.commit()
 
     def copy_to(self, target_id: str):
         """Copy this loop to a new ID."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
+        loop = self.session.exec(
+            select(LoopModel.command, LoopModel.shell).where(
+                LoopModel.id == self.loop_id
+            )
+        ).first()
+        if loop is None:
             raise ValueError(f"Loop {self.loop_id} not found")
+        command, shell = loop
 
         # Check if loop already exists
-        existing = self.session.get(LoopModel, target_id)
-        if existing:
+        if type(self)(target_id, self.session).exists():
             raise ValueError(f"Loop {target_id} already exists")
 
         # Copy loop
-        new_loop = LoopModel(id=target_id, command=loop_model.command)
+        new_loop = LoopModel(id=target_id, command=command, shell=shell)
         self.session.add(new_loop)
+        self.session.flush()
 
         # Copy items
-        for item in loop_model.items:
-            new_item = LoopItem(
-                loop_id=target_id,
-                item=item.item,
-                status=item.status,
-                attempts=item.attempts,
-                last_error=item.last_error,
+        items = self.session.exec(
+            select(
+                LoopItem.item, LoopItem.status, LoopItem.attempts, LoopItem.last_error
             )
-            self.session.add(new_item)
+            .where(LoopItem.loop_id == self.loop_id)
+            .order_by(LoopItem.id)
+        )
+        self.session.bulk_insert_mappings(
+            LoopItem,
+            [
+                {
+                    "loop_id": target_id,
+                    "item": item,
+                    "status": status,
+                    "attempts": attempts,
+                    "last_error": last_error,
+                }
+                for item, status, attempts, last_error in items
+            ],
+        )
 
         self.session.commit()
 
     def add_items(self, items: List[str]):
         """Add items to existing loop."""
-        for item in items:
-            item_model = LoopItem(loop_id=self.loop_id, item=item)
-            self.session.add(item_model)
+        _insert_new_items(self.session, self.loop_id, items)
         self.session.commit()
 
     def replace_items(self, items: List[str]):
         """Replace all items in loop."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
+        # Unlike the other mutations, inserting can't detect a missing loop
+        if not self.exists():
             raise ValueError(f"Loop {self.loop_id} not found")
 
         # Delete existing items
-        for item in loop_model.items:
-            self.session.delete(item)
+        self.session.exec(delete(LoopItem).where(LoopItem.loop_id == self.loop_id))
 
         # Add new items
-        for item in items:
-            item_model = LoopItem(loop_id=self.loop_id, item=item)
-            self.session.add(item_model)
+        _insert_new_items(self.session, self.loop_id, items)
 
         self.session.commit()
 
     def list_items(self):
         """List items in the loop."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
-            return []
-        return [(item.item, item.status, item.attempts) for item in loop_model.items]
+        return self.session.exec(
+            select(LoopItem.item, LoopItem.status, LoopItem.attempts)
+            .where(LoopItem.loop_id == self.loop_id)
+            .order_by(LoopItem.id)
+        ).all()
 
     def get_progress(self):
         """Get loop progress statistics."""
-        loop_model = self.session.get(LoopModel, self.loop_id)
-        if not loop_model:
-            return 0, 0, 0, 0
-
-        items = loop_model.items
-        pending = sum(1 for item in items if item.status == ItemStatus.PENDING)
-        failed = sum(1 for item in items if item.status == ItemStatus.FAILED)
-        done = sum(1 for item in items if item.status == ItemStatus.SUCCESS)
-        total = len(items)
+        counts = dict(
+            self.session.exec(
+                select(LoopItem.status, func.count())
+                .where(LoopItem.loop_id == self.loop_id)
+                .group_by(LoopItem.status)
+            ).all()
+        )
+
+        pending = counts.get(ItemStatus.PENDING, 0)
+        failed = counts.get(ItemStatus.FAILED, 0)
+        done = counts.get(ItemStatus.SUCCESS, 0)
+        total = sum(counts.values())
 
         return pending, failed, done, total
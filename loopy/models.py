@@ -1,10 +1,12 @@
 """SQLModel models for Loopy."""
 
+from sqlalchemy import Index, event, inspect
 from sqlmodel import SQLModel, Field, create_engine, Session, Relationship
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
 import os
+from functools import cache
 from pathlib import Path
 
 
@@ -16,6 +18,7 @@ class ItemStatus(str, Enum):
 
 class LoopItem(SQLModel, table=True):
     __tablename__ = "loop_items"
+    __table_args__ = (Index("ix_loop_items_loopid_status", "loop_id", "status"),)
 
     id: Optional[int] = Field(default=None, primary_key=True)
     loop_id: str = Field(foreign_key="loops.id", ondelete="CASCADE")
@@ -32,21 +35,62 @@ class LoopModel(SQLModel, table=True):
 
     id: str = Field(primary_key=True)
     command: str
+    # Whether the command is run through the shell rather than split into
+    # arguments and run directly
+    shell: bool = Field(default=False)
     created_at: datetime = Field(default_factory=datetime.now)
     status: str = Field(default="active")
 
     items: List["LoopItem"] = Relationship(back_populates="loop", cascade_delete=True)
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL with synchronous=NORMAL only syncs on checkpoints, not every commit
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    cursor.close()
+
+
+def _add_missing_columns(engine):
+    """Add columns that are newer than the database's tables.
+
+    create_all only creates missing tables, so these are added here.
+    """
+    columns = {column["name"] for column in inspect(engine).get_columns("loops")}
+    if "shell" not in columns:
+        with engine.begin() as connection:
+            # Loops created before the column existed were run through the shell
+            connection.exec_driver_sql(
+                "ALTER TABLE loops ADD COLUMN shell BOOLEAN NOT NULL DEFAULT 1"
+            )
+
+
 def get_engine(db_path=None):
     if db_path is None:
         config_dir = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
         db_path = os.path.join(config_dir, "loopy", "db.sqlite")
 
+    return _engine_for(os.path.abspath(db_path))
+
+
+# Not bounded, so that no engine is dropped with its connections still open;
+# a process only opens a few databases
+@cache
+def _engine_for(db_path):
+    """Create the engine for an absolute database path, and its schema."""
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
 
     engine = create_engine(f"sqlite:///{db_path}")
+    event.listen(engine, "connect", _set_sqlite_pragmas)
     SQLModel.metadata.create_all(engine)
+    # create_all skips tables that already exist, along with their indexes
+    for index in LoopItem.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    _add_missing_columns(engine)
     return engine
 
 
@@ -1,17 +1,21 @@
 """Tests for CLI module."""
 
 import pytest
+import os
+import subprocess
+import sys
 import tempfile
 from click.testing import CliRunner
+from sqlmodel import Session, update
 from loopy.cli import main
+from loopy.models import LoopModel, get_engine
 
 
 @pytest.fixture
 def db_path():
     """Create a temporary database path for testing."""
-    with tempfile.NamedTemporaryFile() as f:
-        db_path = f.name
-        yield db_path
+    with tempfile.TemporaryDirectory() as d:
+        yield os.path.join(d, "db.sqlite")
 
 
 def test_list_empty(db_path, monkeypatch):
@@ -69,3 +73,148 @@ def test_delete_nonexistent_loop(db_path, monkeypatch):
 
     assert result.exit_code == 1
     assert "not found" in result.output
+
+
+def test_run_command_jobs(db_path, monkeypatch):
+    """Test running a loop with several jobs."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    runner.invoke(main, ["--id", "test-loop", "create", "echo"], input="a\nb\nc\n")
+    result = runner.invoke(main, ["--id", "test-loop", "run", "--jobs", "2"])
+
+    assert result.exit_code == 0
+    assert sorted(result.output.splitlines()) == ["a: a", "b: b", "c: c"]
+
+
+def test_help_skips_database_imports():
+    """Test --help doesn't pay for importing the database layer."""
+    code = (
+        "import sys\n"
+        "from click.testing import CliRunner\n"
+        "from loopy.cli import main\n"
+        "CliRunner().invoke(main, ['--help'])\n"
+        "print('sqlmodel' in sys.modules)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == "False"
+
+
+def test_edit_cmd_nonexistent_loop(db_path, monkeypatch):
+    """Test updating the command of a non-existent loop."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    result = runner.invoke(main, ["--id", "nonexistent", "edit-cmd", "echo"])
+
+    assert result.exit_code == 1
+    assert "not found" in result.output
+
+
+def test_edit_cmd_and_read_items(db_path, monkeypatch):
+    """Test commands that act on an existing loop."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    runner.invoke(main, ["--id", "test-loop", "create", "echo"], input="item1\n")
+    result = runner.invoke(main, ["--id", "test-loop", "edit-cmd", "cat"])
+    assert result.exit_code == 0
+
+    result = runner.invoke(
+        main, ["--id", "test-loop", "read-items", "--append"], input="item2\n"
+    )
+    assert result.exit_code == 0
+
+    result = runner.invoke(main, ["list"])
+    assert "test-loop: cat {} (2/0/0/2)" in result.output
+
+
+def test_clean_command(db_path, monkeypatch):
+    """Test cleaning removes completed loops."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    runner.invoke(main, ["--id", "test-loop", "create", "true"], input="item1\n")
+    runner.invoke(main, ["--id", "test-loop", "run"])
+    result = runner.invoke(main, ["clean"])
+
+    assert result.exit_code == 0
+    assert result.output == "Cleaned loop test-loop\nCleaned 1 completed loops\n"
+    assert "No loops found" in runner.invoke(main, ["list"]).output
+
+
+def test_read_items_empty_input(db_path, monkeypatch):
+    """Test reading items without providing any keeps the existing ones."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    runner.invoke(main, ["--id", "test-loop", "create", "echo"], input="item1\n")
+    result = runner.invoke(
+        main, ["--id", "test-loop", "read-items", "--replace"], input="\n  \n"
+    )
+
+    assert result.exit_code == 1
+    assert "No items provided" in result.output
+    assert "(1/0/0/1)" in runner.invoke(main, ["list"]).output
+
+
+def test_list_items_command(db_path, monkeypatch):
+    """Test listing items shows their status."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    runner.invoke(
+        main, ["--id", "test-loop", "create", "test", "{}", "=", "a"], input="a\nb\n"
+    )
+    runner.invoke(main, ["--id", "test-loop", "run", "--continue-on-failure"])
+
+    result = runner.invoke(main, ["--id", "test-loop", "list-items"])
+    assert result.exit_code == 0
+    assert result.output == "✓ a\n✗ b (failed 1 times)\n"
+
+    result = runner.invoke(main, ["--id", "test-loop", "list-items", "--raw"])
+    assert result.output == "a\nb\n"
+
+
+def test_unparseable_command(db_path, monkeypatch):
+    """Test commands with unbalanced quotes are reported without a traceback."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        main, ["--id", "test-loop", "create", "echo", "it's", "{}"], input="a\n"
+    )
+    assert result.exit_code == 1
+    assert result.output.startswith("Cannot parse command")
+
+    runner.invoke(main, ["--id", "test-loop", "create", "echo"], input="a\n")
+    result = runner.invoke(main, ["--id", "test-loop", "edit-cmd", "echo", "it's"])
+    assert result.exit_code == 1
+    assert "Cannot parse command" in result.output
+
+    # Stored before templates were validated
+    with Session(get_engine(db_path)) as session:
+        session.exec(update(LoopModel).values(command="echo it's {}"))
+        session.commit()
+    result = runner.invoke(main, ["--id", "test-loop", "run"])
+    assert result.exit_code == 1
+    assert "use edit-cmd --shell" in result.output
+    assert result.exception is None or isinstance(result.exception, SystemExit)
+
+
+def test_create_shell(db_path, monkeypatch):
+    """Test loops created with --shell run their command through the shell."""
+    monkeypatch.setenv("LOOPY_DB", db_path)
+
+    runner = CliRunner()
+    runner.invoke(
+        main,
+        ["--id", "test-loop", "create", "--shell", "test {} = a && true"],
+        input="a\n",
+    )
+    result = runner.invoke(main, ["--id", "test-loop", "run"])
+    assert result.exit_code == 0
+    assert runner.invoke(main, ["--id", "test-loop", "list-items"]).output == "✓ a\n"
@@ -1,11 +1,16 @@
 """Tests for Loop class."""
 
 import pytest
+import os
+import signal
+import sqlite3
 import tempfile
+import threading
 import subprocess
-from unittest.mock import patch, MagicMock
-from sqlmodel import Session
-from loopy.models import get_engine, ItemStatus
+from unittest.mock import patch
+from sqlmodel import Session, update
+from loopy.cli import handler
+from loopy.models import get_engine, ItemStatus, LoopModel
 from loopy.loop import Loop
 
 
@@ -13,22 +18,36 @@ run_kwargs = {
     "shell": True,
     "stdout": subprocess.PIPE,
     "stderr": subprocess.STDOUT,
-    "text": True,
-    "universal_newlines": True,
+    "bufsize": 0,
     "start_new_session": True,
 }
 
+run_kwargs_no_shell = {**run_kwargs, "shell": False}
+
 
 @pytest.fixture
 def db_session():
     """Create a temporary database session for testing."""
-    with tempfile.NamedTemporaryFile() as f:
-        db_path = f.name
-        engine = get_engine(db_path)
+    with tempfile.TemporaryDirectory() as d:
+        engine = get_engine(os.path.join(d, "db.sqlite"))
         with Session(engine) as session:
             yield session
 
 
+def test_get_engine_cached(monkeypatch):
+    """Test each database file gets one engine, however its path is given."""
+    with tempfile.TemporaryDirectory() as d:
+        monkeypatch.setenv("XDG_CONFIG_HOME", d)
+        monkeypatch.chdir(d)
+        engine = get_engine()
+
+        assert get_engine(os.path.join(d, "loopy", "db.sqlite")) is engine
+        assert get_engine(os.path.join("loopy", "db.sqlite")) is engine
+
+        monkeypatch.setenv("XDG_CONFIG_HOME", os.path.join(d, "other"))
+        assert get_engine() is not engine
+
+
 def test_create_loop(db_session):
     """Test creating a loop."""
     loop = Loop.create("test-loop", "echo {}", ["item1", "item2"], db_session)
@@ -47,11 +66,9 @@ def test_create_existing_loop_error(db_session):
         Loop.create("test-loop", "echo {}", ["item2"], db_session)
 
 
-@patch("subprocess.Popen")
+@patch("subprocess.Popen", wraps=subprocess.Popen)
 def test_run_loop_success(mock_run, db_session):
     """Test running a loop successfully."""
-    mock_run.return_value = MagicMock(returncode=0, stderr="")
-
     loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
     success = loop.run()
 
@@ -59,12 +76,10 @@ def test_run_loop_success(mock_run, db_session):
     mock_run.assert_called_once()
 
 
-@patch("subprocess.Popen")
+@patch("subprocess.Popen", wraps=subprocess.Popen)
 def test_run_loop_failure(mock_run, db_session):
     """Test running a loop with failure."""
-    mock_run.return_value = MagicMock(returncode=1, stderr="Command failed")
-
-    loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
+    loop = Loop.create("test-loop", "false {}", ["item1"], db_session)
     success = loop.run()
 
     assert success is False
@@ -79,6 +94,37 @@ def test_reset_loop(db_session):
     assert loop.exists()
 
 
+def test_reset_loop_after_run(db_session):
+    """Test resetting a loop makes failed items pending again."""
+    loop = Loop.create("test-loop", "false {}", ["item1"], db_session)
+    loop.run()
+    loop.reset()
+
+    assert loop.list_items() == [("item1", ItemStatus.PENDING, 0)]
+
+
+def test_update_command(db_session):
+    """Test updating the command of a loop."""
+    loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
+    loop.update_command("cat {}")
+
+    assert Loop.list_all(db_session)[0][1] == "cat {}"
+
+
+def test_nonexistent_loop_errors(db_session):
+    """Test mutating a loop that doesn't exist raises an error."""
+    loop = Loop("nonexistent", db_session)
+
+    for method, args in [
+        (loop.delete, ()),
+        (loop.update_command, ("echo {}",)),
+        (loop.copy_to, ("test-loop-2",)),
+        (loop.replace_items, (["item1"],)),
+    ]:
+        with pytest.raises(ValueError, match="Loop nonexistent not found"):
+            method(*args)
+
+
 def test_delete_loop(db_session):
     """Test deleting a loop."""
     loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
@@ -87,6 +133,20 @@ def test_delete_loop(db_session):
     assert not loop.exists()
 
 
+def test_delete_completed(db_session):
+    """Test deleting only the loops whose items have all succeeded."""
+    Loop.create("done-loop", "true {}", ["item1", "item2"], db_session).run()
+    Loop.create("failed-loop", "false {}", ["item1"], db_session).run()
+    Loop.create("pending-loop", "true {}", ["item1"], db_session)
+    Loop.create("empty-loop", "true {}", [], db_session)
+
+    assert Loop.delete_completed(db_session) == ["done-loop"]
+
+    loops = [loop[0] for loop in Loop.list_all(db_session)]
+    assert sorted(loops) == ["empty-loop", "failed-loop", "pending-loop"]
+    assert Loop("done-loop", db_session).list_items() == []
+
+
 def test_copy_loop(db_session):
     """Test copying a loop."""
     loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
@@ -99,17 +159,115 @@ def test_copy_loop(db_session):
     assert len(loops) == 2
 
 
-@patch("subprocess.Popen")
+def test_copy_loop_existing_target_error(db_session):
+    """Test copying a loop onto an existing ID shows error."""
+    loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
+    Loop.create("test-loop-2", "echo {}", [], db_session)
+
+    assert loop.exists() is True
+    with pytest.raises(ValueError, match="Loop test-loop-2 already exists"):
+        loop.copy_to("test-loop-2")
+
+
+@patch("subprocess.Popen", wraps=subprocess.Popen)
 def test_environment_variable_assignment(mock_run, db_session):
     """Test environment variable assignment in commands."""
-    mock_run.return_value = MagicMock(returncode=0, stderr="")
-
-    loop = Loop.create("test-env", "ENV_VAR=test_value echo {}", ["item1"], db_session)
+    loop = Loop.create(
+        "test-env", "ENV_VAR=test_value echo {}", ["item1"], db_session, shell=True
+    )
     loop.run()
 
     mock_run.assert_called_once_with("ENV_VAR=test_value echo item1", **run_kwargs)
 
 
+@patch("subprocess.Popen", wraps=subprocess.Popen)
+def test_run_without_shell(mock_run, db_session):
+    """Test commands run directly, with the item as a single argument."""
+    loop = Loop.create("test-loop", "echo '<{}>'", ["item 1"], db_session)
+    loop.run()
+
+    mock_run.assert_called_once_with(["echo", "<item 1>"], **run_kwargs_no_shell)
+
+
+def test_unparseable_command_error(db_session):
+    """Test a command that can't be split into arguments is rejected."""
+
+    def items():
+        pytest.fail("Items read before the command was checked")
+        yield
+
+    with pytest.raises(ValueError, match="Cannot parse command.*No closing quotation"):
+        Loop.create("test-loop", "echo it's {}", items(), db_session)
+
+    loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
+    with pytest.raises(ValueError, match="Cannot parse command"):
+        loop.update_command("echo it's {}")
+
+    # Stored before templates were validated
+    db_session.exec(update(LoopModel).values(command="echo it's {}"))
+    db_session.commit()
+    with pytest.raises(ValueError, match="use edit-cmd --shell"):
+        loop.run()
+    assert loop.list_items() == [("item1", ItemStatus.PENDING, 0)]
+
+
+@patch("subprocess.Popen", wraps=subprocess.Popen)
+def test_shell_mode_stored(mock_run, db_session):
+    """Test whether the command is run through the shell is kept with the loop."""
+    loop = Loop.create("test-loop", "echo {} >/dev/null", ["item1"], db_session)
+    loop.update_command("echo {} >/dev/null", shell=True)
+    loop.copy_to("copy-loop")
+    Loop("copy-loop", db_session).run()
+
+    mock_run.assert_called_once_with("echo item1 >/dev/null", **run_kwargs)
+
+
+def test_shell_column_added():
+    """Test loops in databases older than the shell column are run through the shell."""
+    with tempfile.TemporaryDirectory() as d:
+        db_path = os.path.join(d, "db.sqlite")
+        with sqlite3.connect(db_path) as connection:
+            connection.executescript(
+                "CREATE TABLE loops (id VARCHAR NOT NULL PRIMARY KEY, "
+                "command VARCHAR NOT NULL, created_at DATETIME NOT NULL, "
+                "status VARCHAR NOT NULL);"
+                "INSERT INTO loops VALUES ('old', 'echo {} | cat', '2024-01-01', '');"
+            )
+        connection.close()
+
+        with Session(get_engine(db_path)) as session:
+            assert session.get(LoopModel, "old").shell is True
+
+
+def test_run_missing_program(db_session, capsys):
+    """Test an item fails when its program doesn't exist."""
+    loop = Loop.create("test-loop", "loopy-missing-program {}", ["item1"], db_session)
+
+    assert loop.run() is False
+    assert capsys.readouterr().out.startswith("item1: [Errno 2]")
+    assert loop.list_items() == [("item1", ItemStatus.FAILED, 1)]
+
+
+def test_run_missing_program_batches(db_session, monkeypatch):
+    """Test failures to start a program are written in full batches."""
+    monkeypatch.setattr("loopy.loop.COMMIT_BATCH_SIZE", 2)
+    items = ["item1", "item2", "item3"]
+    loop = Loop.create("test-loop", "loopy-missing-program {}", items, db_session)
+
+    batches = []
+    commit_updates = loop._commit_updates
+
+    def record(updates):
+        batches.append(len(updates))
+        commit_updates(updates)
+
+    monkeypatch.setattr(loop, "_commit_updates", record)
+
+    assert loop.run(continue_on_failure=True) is False
+    assert batches == [2, 1]
+    assert [status for _, status, _ in loop.list_items()] == [ItemStatus.FAILED] * 3
+
+
 def test_add_items(db_session):
     """Test adding items to existing loop."""
     loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
@@ -122,6 +280,21 @@ def test_add_items(db_session):
     assert ("item3", ItemStatus.PENDING, 0) in items
 
 
+def test_add_items_in_batches(db_session, monkeypatch):
+    """Test items are inserted across several batches."""
+    monkeypatch.setattr("loopy.loop.INSERT_BATCH_SIZE", 2)
+    loop = Loop.create("test-loop", "echo {}", ["item1", "item2"], db_session)
+    loop.add_items(["item3", "item4", "item5"])
+
+    assert [item for item, _, _ in loop.list_items()] == [
+        "item1",
+        "item2",
+        "item3",
+        "item4",
+        "item5",
+    ]
+
+
 def test_replace_items(db_session):
     """Test replacing all items in loop."""
     loop = Loop.create("test-loop", "echo {}", ["item1", "item2"], db_session)
@@ -142,3 +315,122 @@ def test_list_items(db_session):
     assert len(items) == 2
     assert ("item1", ItemStatus.PENDING, 0) in items
     assert ("item2", ItemStatus.PENDING, 0) in items
+
+
+def test_list_items_nonexistent_loop(db_session):
+    """Test listing items of a loop that doesn't exist."""
+    assert Loop("nonexistent", db_session).list_items() == []
+
+
+@patch("subprocess.Popen", wraps=subprocess.Popen)
+def test_run_loop_only_pending(mock_run, db_session):
+    """Test running a loop again only runs the items still pending."""
+    loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
+    loop.run()
+    loop.add_items(["item2"])
+    loop.run()
+
+    assert mock_run.call_count == 2
+    assert mock_run.call_args.args == (["echo", "item2"],)
+    assert loop.get_progress() == (0, 0, 2, 2)
+
+
+def test_run_loop_records_status(db_session):
+    """Test running a loop persists the status of every item."""
+    loop = Loop.create("test-loop", "false {}", ["item1", "item2"], db_session)
+    loop.run(continue_on_failure=True)
+
+    items = loop.list_items()
+    assert ("item1", ItemStatus.FAILED, 1) in items
+    assert ("item2", ItemStatus.FAILED, 1) in items
+    assert loop.get_progress() == (0, 2, 0, 2)
+
+
+def test_list_all_progress(db_session):
+    """Test listing loops reports per-status item counts."""
+    loop = Loop.create("test-loop", "false {}", ["item1", "item2"], db_session)
+    loop.run()
+    Loop.create("empty-loop", "echo {}", [], db_session)
+
+    loops = {loop[0]: loop for loop in Loop.list_all(db_session)}
+    assert loops["test-loop"] == ("test-loop", "false {}", "active", 1, 1, 0, 2)
+    assert loops["empty-loop"] == ("empty-loop", "echo {}", "active", 0, 0, 0, 0)
+
+
+def test_run_loop_streams_output(db_session, capsys):
+    """Test command output is printed line by line, prefixed with the item."""
+    loop = Loop.create(
+        "test-loop", "printf 'a\\nb'; : {}", ["item1"], db_session, shell=True
+    )
+    loop.run()
+
+    assert capsys.readouterr().out == "item1: a\nitem1: b\n"
+
+
+@patch("os.pidfd_open", side_effect=OSError, create=True)
+def test_run_loop_without_pidfd(mock_pidfd_open, db_session, capsys):
+    """Test output is still streamed when pidfd_open is not supported."""
+    loop = Loop.create("test-loop", "echo {}", ["item1"], db_session)
+
+    assert loop.run() is True
+    assert capsys.readouterr().out == "item1: item1\n"
+
+
+def test_run_loop_jobs(db_session):
+    """Test items run concurrently when jobs is greater than one."""
+    with tempfile.TemporaryDirectory() as d:
+        marker = os.path.join(d, "second")
+        # The first item only succeeds if the second one runs alongside it
+        command = (
+            f"if [ {{}} = first ]; then "
+            f"for i in $(seq 100); do [ -e {marker} ] && exit 0; sleep 0.05; done; "
+            f"exit 1; else touch {marker}; fi"
+        )
+        loop = Loop.create(
+            "test-loop", command, ["first", "second"], db_session, shell=True
+        )
+
+        assert loop.run(jobs=2) is True
+        assert loop.get_progress() == (0, 0, 2, 2)
+
+
+def test_run_loop_jobs_stop_on_failure(db_session):
+    """Test no new items are started after a failure."""
+    command = "test {} != fail && sleep 0.2"
+    loop = Loop.create("test-loop", command, ["fail", "a", "b"], db_session, shell=True)
+
+    assert loop.run(jobs=2) is False
+    assert loop.get_progress() == (1, 1, 1, 3)
+
+
+def test_run_loop_passes_output_through(db_session, capsysbinary):
+    """Test command output is written as raw bytes, without decoding."""
+    loop = Loop.create(
+        "test-loop", "printf '\\377\\n'; : {}", ["item1"], db_session, shell=True
+    )
+    loop.run()
+
+    assert capsysbinary.readouterr().out == b"item1: \xff\n"
+
+
+def test_run_loop_sigterm(db_session):
+    """Test SIGTERM stops the running command and marks its item failed."""
+    loop = Loop.create(
+        "test-loop", "sleep 10; : {}", ["item1", "item2"], db_session, shell=True
+    )
+
+    previous = signal.signal(signal.SIGTERM, handler)
+    timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        with pytest.raises(SystemExit) as exc_info:
+            loop.run()
+    finally:
+        timer.cancel()
+        signal.signal(signal.SIGTERM, previous)
+
+    assert exc_info.value.code == 143
+    assert loop.list_items() == [
+        ("item1", ItemStatus.FAILED, 1),
+        ("item2", ItemStatus.PENDING, 0),
+    ]